@@ -23,7 +23,12 @@ from load_db import load_instances
 
 
 #Default variables
-DEFAULT_PREVIOUS_CODES = []
+DEFAULT_TABLE_COLS = (
+    'code', 'date', 'time',
+    'latitude', 'longitude', 'depth',
+    'magnitude', 'magnitude type', 'region',
+    'area', 'source', 'other_code'
+)
 
 
 #Getting all earthquake files
@@ -50,7 +55,9 @@ def get_earthquake_df(my_file):
     """
     Description
     -----------
-    Returns a pandas dataset of earthquake csv file
+    Returns a pandas dataset of earthquake csv file.
+    Column names are replaced by DEFAULT_TABLE_COLS so
+    they are not dependant on download language.
 
     Parameters
     ----------
@@ -61,17 +68,16 @@ def get_earthquake_df(my_file):
     -------
     A pandas DataFrame object of the earthquake data
     """
-    return pandas.read_csv("./ETL/earthquakes/{}".format(my_file), sep=',')
+    return pandas.read_csv("./ETL/earthquakes/{}".format(my_file), sep=',', header=0, names=DEFAULT_TABLE_COLS)
 
 
 #Creating earthquake instances
-def create_earthquake_instances(my_df, previous_codes):
+def create_earthquake_instances(my_df):
     ##Documentation
     """
     Description
     -----------
-    Changes dataframe columns so they are not dependant on download language.
-    Eliminates instances with repeated codes from previous files.
+    Eliminates instances with repeated codes, keeping the first one found.
     Excludes non-local earthquakes and earthquakes not sourced by the ICGC.
     Eliminates unnecessary colums to create database instance.
     
@@ -84,10 +90,8 @@ def create_earthquake_instances(my_df, previous_codes):
             code, date, time, latitude,
             longitude, depth, magnitude,
             magnitude type, region, area,
-            source, code
+            source, other_code
         )
-    previous_codes: list[str]
-        List of earthquake codes from previous files 
     
     Returns
     -------
@@ -98,40 +102,26 @@ def create_earthquake_instances(my_df, previous_codes):
             code, date, time, latitude,
             longitude, depth, magnitude
         )
-    unique_codes: list
-        A list of the dataset's not repeated codes
     """
-    ##Changing column names
-    table_cols = my_df.columns
-    default_table_cols = (
-        'code', 'date', 'time',
-        'latitude', 'longitude', 'depth',
-        'magnitude', 'magnitude type', 'region',
-        'area', 'source', 'other_code'
-    )
-    cols_dict = dict((k,v) for k,v in zip(table_cols, default_table_cols))
-    my_df = my_df.rename(columns=cols_dict)
-    
     ##Filtering earthquakes
-    unique_codes = list(set(my_df['code']).difference(set(previous_codes)))
-    my_df = my_df[(my_df['code'].isin(unique_codes)) & (my_df['area']=='Local') & (my_df['source']=='ICGC')]
+    my_df = my_df.drop_duplicates(subset='code')
+    my_df = my_df[(my_df['area']=='Local') & (my_df['source']=='ICGC')]
 
     ##Eliminating unnecessary columns
     my_df = my_df[my_df.columns[:7]]
 
     ##Creating instances
     earthquake_instances = my_df.values.tolist()
-    return (earthquake_instances, unique_codes)
+    return earthquake_instances
 
 
 #Main
 def main():
-    previous_codes = DEFAULT_PREVIOUS_CODES
     earthquake_files = get_earthquake_files()
-    for earthquake_file in earthquake_files:
-        earthquake_table = get_earthquake_df(earthquake_file)
-        earthquake_instances, previous_codes = create_earthquake_instances(earthquake_table, previous_codes)
-        load_instances(earthquake_instances, 'earthquake')
+    earthquake_tables = [get_earthquake_df(earthquake_file) for earthquake_file in earthquake_files]
+    earthquake_table = pandas.concat(earthquake_tables, ignore_index=True)
+    earthquake_instances = create_earthquake_instances(earthquake_table)
+    load_instances(earthquake_instances, 'earthquake')
 
 
 #Execution
@@ -11,21 +11,21 @@ __date__ = "08/09/2021"
 
 #Libraries
 ##Standard
-from datetime import datetime
-from math import ceil, floor
+from multiprocessing import Pool
 import os
 from random import choice, randint
 import sys
 
 ##Packages
 import matplotlib.pyplot as plt
+import numpy as np
 from object_detection.utils import dataset_util
 import pandas as pd
-import sqlite3
+from PIL import Image
 import tensorflow.compat.v1 as tf
 
 ##Local
-from load_db import LOCAL_SEISMIC_DB, TRACE_LOCATION_MAP
+from load_db import load_instances, open_db, TRACE_LOCATION_MAP
 
 ##Constants
 P_MARGIN = 100
@@ -54,15 +54,18 @@ def extract_spectrograms(spectrogram_type):
     """
     
     ##Connecting to db
-    connection = sqlite3.Connection(LOCAL_SEISMIC_DB)
+    connection = open_db()
     cursor = connection.cursor()
 
     ##Querying db and creating dataframe
     my_query = """select t.code, t.name, t.component, t.start, t.final, r.p_time, r.s_time, t.location\
         from trace as t join register as r on t.code=r.code and t.name=r.name\
             where t.type={}""".format(spectrogram_type)
-    spectrograms = pd.DataFrame(cursor.execute(my_query))
-    spectrograms.columns = ('code', 'name', 'component', 'start', 'final', 'p_pick', 's_pick', 'location')
+    spectrograms = cursor.execute(my_query).fetchall()
+    spectrograms = pd.DataFrame.from_records(
+        spectrograms,
+        columns=('code', 'name', 'component', 'start', 'final', 'p_pick', 's_pick', 'location')
+    )
 
     ##Closing db
     cursor.close()
@@ -85,10 +88,11 @@ def extract_image_size():
         Image dimensions (heigth, width, channel)
     """
     
-    ##Loading random image and returning dimensions
+    ##Reading a random image header and returning dimensions
     file = choice(os.listdir())
-    fig = plt.imread(file)
-    shape = fig.shape
+    with Image.open(file) as image:
+        width, height = image.size
+        shape = (height, width, len(image.getbands()))
     return shape
     
 
@@ -119,25 +123,25 @@ def transform_spectrograms(spectrograms, img_window):
     """
     
     ##Creating file column from locations
-    spectrograms['file'] = [ trace_location.split('\\')[-1] for trace_location in spectrograms['location']]
+    spectrograms['file'] = spectrograms['location'].str.rsplit(os.sep, n=1).str[-1]
     del spectrograms['location']
 
     ##Converting timestamps to datetime objects
     DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
     TIME_FORMAT = "%H:%M:%S.%f"
-    to_datetime = lambda d,f: [ datetime.strptime(x,f) for x in spectrograms[d] ]
+    to_datetime = lambda d,f: pd.to_datetime(spectrograms[d], format=f, cache=True)
     spectrograms['start'] = to_datetime('start', DATETIME_FORMAT)
     spectrograms['final'] = to_datetime('final', DATETIME_FORMAT)
     spectrograms['p_pick'] = to_datetime('p_pick', TIME_FORMAT)
     spectrograms['s_pick'] = to_datetime('s_pick', TIME_FORMAT)
 
     ##Asigning p_pick and s_pick a date
-    assign_date = lambda c: [datetime.combine(d.date(),t.time()) for d,t in zip(spectrograms['start'],spectrograms[c])]
+    assign_date = lambda c: spectrograms['start'].dt.normalize() + (spectrograms[c] - spectrograms[c].dt.normalize())
     spectrograms['p_pick'] = assign_date('p_pick')
     spectrograms['s_pick'] = assign_date('s_pick')
 
     ##Converting time intervals from start to total miliseconds
-    to_interval = lambda d: [ pick.total_seconds() * 1000 for pick in (spectrograms[d] - spectrograms['start'])]
+    to_interval = lambda d: (spectrograms[d] - spectrograms['start']).dt.total_seconds() * 1000
     spectrograms['window'] = to_interval('final')
     spectrograms['p_pick'] = to_interval('p_pick')
     spectrograms['s_pick'] = to_interval('s_pick')
@@ -145,20 +149,18 @@ def transform_spectrograms(spectrograms, img_window):
     del spectrograms['final']
 
     ##Converting time interval into image pixels
-    to_image_coords = lambda p: [ floor(pick) for pick in spectrograms[p]*spectrograms['ppms'] ]
-    spectrograms['ppms'] = img_window/spectrograms['window']
-    spectrograms['p_pick'] = to_image_coords('p_pick')
-    spectrograms['s_pick'] = to_image_coords('s_pick')
+    ppms = img_window/spectrograms['window'].to_numpy()
+    p_coords = np.floor(spectrograms['p_pick'].to_numpy()*ppms).astype(np.int64)
+    s_coords = np.floor(spectrograms['s_pick'].to_numpy()*ppms).astype(np.int64)
+    spectrograms['p_pick'] = p_coords
+    spectrograms['s_pick'] = s_coords
     del spectrograms['window']
 
     ##Using margins to select earthquake
-    ajust_limit = lambda e_f: e_f if e_f<=img_window else img_window
-    spectrograms['e_start'] = spectrograms['p_pick'] - [ceil(value) for value in P_MARGIN*spectrograms['ppms']]
-    spectrograms['e_final'] = spectrograms['s_pick'] + [ceil(value) for value in S_MARGIN*spectrograms['ppms']]
+    spectrograms['e_start'] = p_coords - np.ceil(P_MARGIN*ppms).astype(np.int64)
+    spectrograms['e_final'] = np.minimum(s_coords + np.ceil(S_MARGIN*ppms).astype(np.int64), img_window)
     print(img_window)
     print(spectrograms)
-    spectrograms['e_final'] = [ajust_limit(e_f) for e_f in spectrograms['e_final']]
-    del spectrograms['ppms']
 
     return spectrograms
 
@@ -226,7 +228,7 @@ def create_record(path ,filename, e_start, e_final, width, height):
     """
     
     ##Loading image
-    with tf.gfile.GFile(os.path.join(path, filename), 'rb') as fid:
+    with open(os.path.join(path, filename), 'rb') as fid:
         encoded_jpg = fid.read()
     
     ##Creating record parameters
@@ -257,7 +259,7 @@ def create_record(path ,filename, e_start, e_final, width, height):
 
 
 #Loading record to file
-def fc_load_record_file(spectrogram_folder, record_folder, width, height, total_spectrograms):
+def fc_load_record_file(spectrogram_folder, width, height, total_spectrograms):
     ##Documentation
     """
     Description
@@ -269,8 +271,6 @@ def fc_load_record_file(spectrogram_folder, record_folder, width, height, total_
     ----------
     spectrogram_folder: str
         Spectrogram images folder
-    record_folder:
-        Train and test record's folder
     width: int
         Image witdth
     height: int
@@ -285,22 +285,99 @@ def fc_load_record_file(spectrogram_folder, record_folder, width, height, total_
     """
     
     ##Using parameters to create the loading function
+    spectrogram_folder = os.path.abspath(spectrogram_folder)
     def load_record_file(writer, s_i):
-        i, s_i = s_i
-        code = s_i['code']
-        name = s_i['name']
-        component = s_i['component']
-        file = s_i['file']
-        e_start = s_i['e_start']
-        e_final = s_i['e_final']
-        os.chdir(spectrogram_folder)
+        i = s_i.Index
+        code = s_i.code
+        name = s_i.name
+        component = s_i.component
+        file = s_i.file
+        e_start = s_i.e_start
+        e_final = s_i.e_final
         tf_example = create_record(spectrogram_folder, file, e_start, e_final, width, height)
-        os.chdir(record_folder)
         writer.write(tf_example.SerializeToString())
         print("{}_{}_{}: {}/{}".format(code, name, component, i+1, total_spectrograms))
     return load_record_file
 
 
+#Loading a record shard to file
+def load_record_shard(shard_args):
+    ##Documentation
+    """
+    Description
+    -----------
+    Writes a slice of the spectrograms dataframe into its own record
+    file. Used as the worker function of the process pool that writes
+    all record shards in parallel.
+    
+    Parameters
+    ----------
+    shard_args: tuple
+        Shard arguments: spectrogram_folder, width, height, total_spectrograms,
+        shard_location and the spectrograms dataframe slice to write
+    """
+    
+    ##Writing every example of the slice to the shard file
+    spectrogram_folder, width, height, total_spectrograms, shard_location, s_shard = shard_args
+    load_record_file = fc_load_record_file(spectrogram_folder, width, height, total_spectrograms)
+    writer = tf.python_io.TFRecordWriter(shard_location)
+    for s_i in s_shard.itertuples():
+        load_record_file(writer, s_i)
+    writer.close()
+
+
+#Loading records to sharded files
+def load_record_shards(spectrograms, record_location, spectrogram_folder, width, height, total_spectrograms):
+    ##Documentation
+    """
+    Description
+    -----------
+    Splits the spectrograms dataframe into one slice per cpu and writes
+    each slice to a record shard named record_location-XXXXX-of-YYYYY
+    using a process pool.
+    
+    Parameters
+    ----------
+    spectrograms: pandas.core.frame.DataFrame
+        Spectrograms train or test dataframe
+    record_location: str
+        Record file location, used as the shard name prefix
+    spectrogram_folder: str
+        Spectrogram images folder
+    width: int
+        Image witdth
+    height: int
+        Image heigth
+    total_spectrograms: int
+        Total number of spectrogram images
+    
+    Returns
+    -------
+    shard_column: list
+        Shard location of every spectrogram in the dataframe
+    """
+    
+    ##Splitting dataframe into shards
+    n_shards = max(1, min(os.cpu_count(), len(spectrograms)))
+    shard_indexes = np.array_split(np.arange(len(spectrograms)), n_shards)
+    shard_locations = [
+        '{}-{:05d}-of-{:05d}'.format(record_location, i, n_shards)
+        for i in range(n_shards)
+    ]
+    shard_args = [
+        (spectrogram_folder, width, height, total_spectrograms, location, spectrograms.iloc[indexes])
+        for location, indexes in zip(shard_locations, shard_indexes)
+    ]
+
+    ##Writing shards in parallel
+    with Pool(n_shards) as pool:
+        pool.map(load_record_shard, shard_args)
+
+    ##Assigning each spectrogram its shard location
+    shard_column = np.repeat(shard_locations, [len(indexes) for indexes in shard_indexes]).tolist()
+    return shard_column
+
+
 #Load record to database
 def load_record_db(spectrograms):
     ##Documentation
@@ -317,19 +394,9 @@ def load_record_db(spectrograms):
         Spectrograms train or test dataframe
     """
     
-    ##Connecting to db
-    connection = sqlite3.connect(LOCAL_SEISMIC_DB)
-    cursor = connection.cursor()
-
-    ##Inserting values into db
-    spectrograms = str(list(spectrograms.itertuples(index=False, name=None)))[1:-1]
-    my_query = "INSERT INTO record VALUES {}".format(spectrograms)
-    cursor.execute(my_query)
-    connection.commit()
-
-    ##Closing db
-    cursor.close()
-    connection.close()
+    ##Inserting values into db with a parameterized batch insert
+    record_instances = list(spectrograms.itertuples(index=False, name=None))
+    load_instances(record_instances, 'record')
 
 
 #Main
@@ -366,27 +433,20 @@ def main():
     s_train = spectrograms.iloc[:split_index].copy()
     s_test = spectrograms.iloc[split_index:].copy()
 
-    ##Creating a function to load the records
-    load_record_file = fc_load_record_file(spectrogram_folder, record_folder, width, height, total_spectrograms)
-    
     ##Writing train records
-    writer_train = tf.python_io.TFRecordWriter(train_record_location)
-    [load_record_file(writer_train, s_i) for s_i in s_train.iterrows()]
-    writer_train.close()
+    train_shards = load_record_shards(s_train, train_record_location, spectrogram_folder, width, height, total_spectrograms)
 
     ##Writing test records
-    writer_test = tf.python_io.TFRecordWriter(test_record_location)
-    [load_record_file(writer_test, s_i) for s_i in s_test.iterrows()]
-    writer_test.close()
+    test_shards = load_record_shards(s_test, test_record_location, spectrogram_folder, width, height, total_spectrograms)
 
     ##Loading records to db
     os.chdir(script_folder)
     del s_train['file']
     s_train['split'] = 0
-    s_train['location'] = train_record_location
+    s_train['location'] = train_shards
     del s_test['file']
     s_test['split'] = 1
-    s_test['location'] = test_record_location
+    s_test['location'] = test_shards
     load_record_db(s_train)
     load_record_db(s_test)
 
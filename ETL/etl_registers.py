@@ -11,12 +11,22 @@ __author__='Waskar-coding'
 __date__='14/08/2021'
 
 #Libraries
+##Standard
+from concurrent.futures import ThreadPoolExecutor
+
 ##Packages
 import requests
-import sqlite3
 
 ##Local scripts
-from load_db import load_instances, LOCAL_SEISMIC_DB
+from load_db import load_instances, open_db
+
+
+#Constants
+GSE_URL = 'https://sismocat.icgc.cat/sisweb2/siswebclient_gse_external.php?seccio=gse&codi='
+MAX_WORKERS = 32
+LOAD_BATCH_SIZE = 500
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
 
 
 #Extract: Getting register table
@@ -25,9 +35,9 @@ def extract_earthquake_codes():
     """
     Description
     -----------
-    Extracts all earthquake codes from the earthquake and register tables
-    of the local database and finds the earthquake codes that do not appear
-    in the register table.
+    Queries the local database for the earthquake codes that do not
+    appear in the register table, the set difference is computed by
+    sqlite.
     
     Returns
     -------
@@ -37,20 +47,18 @@ def extract_earthquake_codes():
     """
     
     ##Connect to database
-    connection = sqlite3.connect(LOCAL_SEISMIC_DB)
+    connection = open_db()
     cursor = connection.cursor()
 
-    ##Load instances
-    codes_e = cursor.execute("SELECT (code) FROM earthquake").fetchall()
-    codes_r = cursor.execute("SELECT (code) FROM register").fetchall()
-    codes = list(set(codes_e).difference(set(codes_r)))
+    ##Load codes missing from the register table
+    cursor.execute("SELECT code FROM earthquake EXCEPT SELECT code FROM register")
+    codes = [code_tuple[0] for code_tuple in cursor]
 
-    ##Save changes and close
+    ##Close
     cursor.close()
     connection.close()
 
     ##Return list of codes
-    codes = list(map(lambda code_tuple: code_tuple[0], codes))
     return codes
 
 
@@ -85,16 +93,17 @@ def extract_registers(earthquake_code):
         None is returned
     """
     
-    ##Querying ICGC database
-    response = requests.get('https://sismocat.icgc.cat/sisweb2/siswebclient_gse_external.php?seccio=gse&codi=' + earthquake_code)
+    ##Querying ICGC database (the shared session keeps connections alive)
+    response = SESSION.get(GSE_URL + earthquake_code)
 
     ##Selecting table
     has_registers = False
-    register_table = str(response.content).split('\\r\\n')
+    register_table = response.text.split('\r\n')
     for i,line in enumerate(register_table):
         if line.startswith('Sta'):
             register_index = i + 1
             has_registers = True
+            break
     if has_registers == False:
         print(earthquake_code)
         register_table = None
@@ -102,101 +111,32 @@ def extract_registers(earthquake_code):
     register_table = register_table[register_index:-2]
 
     ##Parsing register table
-    register_table = list(map(
-        lambda line: tuple(filter(
-            lambda w: w != '',
-            line.split(' ')
-        )),
-        register_table
-    ))
+    register_table = [tuple(line.split()) for line in register_table]
     return register_table
 
 
-#Transform: Selecting P and S pairs
-def transform_registers_raw_to_pairs(register_raw):
-    ##Documentation
-    """
-    Description
-    -----------
-    Pairs P and S wave registers for each station, eliminates
-    registers that do not have a pairing station. Registers from
-    the same station appear next to each other in the table. This
-    function will check consecutive registers to find pairs and add
-    their registers togheter into a pair list.
-    
-    Parameters
-    ----------
-    register_raw: list
-        List of tuples containing each P and S wave register of an
-        earthquake.
-    
-    Returns
-    -------
-    register_pairs: list
-        List of tuple pairs containing instances of register_raw
-        that share a station.
-    """
-    
-    register_pairs = []
-    contador = 0
-    while contador < len(register_raw)-1:
-        p_line = register_raw[contador]
-        s_line = register_raw[contador+1]
-        if p_line[0] == s_line[0]:
-            register_pairs.append((p_line, s_line))
-            contador += 2
-        else:
-            contador += 1
-    return register_pairs
-    
-
-#Transform: Filtering deep phases
-def transform_registers_pairs_filter(register_pairs):
-    ##Documentation
-    """
-    Description
-    -----------
-    Filters deep phases (P or S phases not named with a single P or S),
-    and register pairs with incomplete P or S phase registers (they must
-    be of a certain length).
-    
-    Parameters
-    ----------
-    register_pairs: list
-        List of tuple pairs containing instances of registers
-        that share a station.
-    
-    Returns
-    -------
-    filtered_register_pairs: list
-        Register pairs that have passed this function filters
-    
-    """
-    
-    
-    ##Filtering out deep phases
-    register_pairs = list(filter(lambda r: r[0][3]=='P' and r[1][3]=='S', register_pairs))
-
-    ##Filtering out incomplete registers
-    filtered_register_pairs = list(filter(lambda r: len(r[0])==8 and len(r[1])==12, register_pairs))
-    return filtered_register_pairs
-
-
 #Transform: Crafting registers
-def transform_registers_pairs_to_instances(code, register_pairs):
+def transform_registers_raw_to_instances(code, register_raw):
     ##Documentation
     """
     Description
     -----------
-    Transforms register pairs into the local database format
+    Pairs P and S wave registers for each station and transforms the
+    pairs into the local database format. Registers are first grouped
+    by station code, so pairing does not depend on registers from the
+    same station appearing next to each other in the table. Each
+    station's registers are then paired in order. Registers without
+    a pairing station, deep phases (P or S phases not named with a single
+    P or S) and incomplete P or S phase registers (they must be of a
+    certain length) are discarted.
     
     Parameters
     ----------
     code: str
         An ICGC earthquake code, a 5 digit number
-    register_pairs: list
-        List of tuple pairs containing instances of registers
-        that share a station.
+    register_raw: list
+        List of tuples containing each P and S wave register of an
+        earthquake.
     
     Returns
     -------
@@ -206,11 +146,17 @@ def transform_registers_pairs_to_instances(code, register_pairs):
         tuples adjusts to the register table schema in the local database.
     """
     
-    ##Transforming instance pairs to db format
+    ##Grouping registers by station
+    station_registers = {}
+    for register in register_raw:
+        station_registers.setdefault(register[0], []).append(register)
+
+    ##Pairing, filtering and transforming registers to db format
     register_instances = []
-    for register_pair in register_pairs:
-        p_r, s_r = register_pair
-        register_instances.append((code, p_r[0], p_r[1], p_r[4], s_r[4], s_r[7], s_r[8]))
+    for registers in station_registers.values():
+        for p_r, s_r in zip(registers[::2], registers[1::2]):
+            if p_r[3] == 'P' and s_r[3] == 'S' and len(p_r) == 8 and len(s_r) == 12:
+                register_instances.append((code, p_r[0], p_r[1], p_r[4], s_r[4], s_r[7], s_r[8]))
     return register_instances
 
 
@@ -219,19 +165,30 @@ def main():
     earthquake_codes = extract_earthquake_codes()
     total_codes = len(earthquake_codes)
     counter = 0
-    for earthquake_code in earthquake_codes:
-        registers_raw = extract_registers(earthquake_code)
-        if registers_raw == None:
-            continue
-        register_pairs = transform_registers_raw_to_pairs(registers_raw)
-        register_pairs = transform_registers_pairs_filter(register_pairs)
-        register_instances = transform_registers_pairs_to_instances(earthquake_code,register_pairs)
-        if(len(register_instances) == 0):
-            continue
-        load_instances(register_instances, 'register')
-
-        counter+=1
-        print("{}: {}/{}".format(earthquake_code, counter, total_codes))
+    register_buffer = []
+    connection = open_db()
+    try:
+        with ThreadPoolExecutor(MAX_WORKERS) as executor:
+            registers_responses = executor.map(extract_registers, earthquake_codes)
+            for earthquake_code, registers_raw in zip(earthquake_codes, registers_responses):
+                if registers_raw == None:
+                    continue
+                register_instances = transform_registers_raw_to_instances(earthquake_code, registers_raw)
+                if(len(register_instances) == 0):
+                    continue
+                register_buffer.extend(register_instances)
+                if len(register_buffer) >= LOAD_BATCH_SIZE:
+                    load_instances(register_buffer, 'register', connection)
+                    register_buffer.clear()
+
+                counter+=1
+                print("{}: {}/{}".format(earthquake_code, counter, total_codes))
+
+    finally:
+        ##Loading remaining registers, even if a request failed
+        if len(register_buffer) != 0:
+            load_instances(register_buffer, 'register', connection)
+        connection.close()
 
 
 #Execution
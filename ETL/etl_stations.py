@@ -13,10 +13,18 @@ __date__ = '15/08/2021'
 
 
 #Libraries
+##Packages
+import pandas as pd
+
 ##Local
 from load_db import load_instances
 
 
+#Constants
+STATION_COLS = ('network', 'name', 'lat', 'lon', 'alt', 'type')
+BROADBAND_TYPES = ['Broadband velocimeter', 'Broadband velocimeter and Accelerometer']
+
+
 #Getting stations raw list
 def get_stations_raw():
     ##Documentation
@@ -47,6 +55,8 @@ def create_station_instances(station_list_raw):
     -----------
     Parses station information and transforms it into the
     format of the station table in to the local database.
+    Each station takes three lines of the raw list (code, url
+    and data), which are joined into a single dataframe row.
     Only stations containing a broadband velocimeter are
     selected.
     
@@ -64,16 +74,21 @@ def create_station_instances(station_list_raw):
     """
     
     ##Parsing stations
-    stations_instances = []
-    while len(station_list_raw) > 0:
-        current_station = station_list_raw[:3]
-        station_list_raw = station_list_raw[3:]
-        st_network, st_name = current_station[0].strip('\n').split('.')
-        st_data = current_station[2].split('\t')
-        st_lat, st_lon, st_alt = st_data[1:4]
-        st_type = st_data[4]
-        if(st_type == 'Broadband velocimeter' or st_type == 'Broadband velocimeter and Accelerometer'):
-            stations_instances.append((st_name, st_network, float(st_lat), float(st_lon), int(st_alt)))
+    station_lines = iter(station_list_raw)
+    stations_df = pd.DataFrame(
+        [
+            code_line.strip('\n').split('.') + data_line.split('\t')[1:5]
+            for code_line, _, data_line in zip(station_lines, station_lines, station_lines)
+        ],
+        columns=STATION_COLS
+    )
+
+    ##Selecting broadband stations
+    stations_df = stations_df[stations_df['type'].isin(BROADBAND_TYPES)]
+    stations_df = stations_df.astype({'lat': float, 'lon': float, 'alt': int})
+
+    ##Creating instances
+    stations_instances = list(stations_df[['name', 'network', 'lat', 'lon', 'alt']].itertuples(index=False, name=None))
     return stations_instances
 
 
@@ -1,6 +1,6 @@
 #Description
 """
-Applies an obspy filter to a raw trace and saves the modified version.
+Applies a Butterworth filter to a raw trace and saves the modified version.
 
 To execute this script you need to activate a conda environment with obpsy installed:
 
@@ -8,7 +8,7 @@ conda activate [obspy environment]
 
 These are the arguments to execute the script:
 
-python etl_traces_spectrum.py type_i type_f filter_type fre_min [freq_max]
+python etl_traces_spectrum.py type_i type_f filter_type fre_min [freq_max] [fft]
 
     type_i: Initial type, an integer that references a trace type
 
@@ -20,6 +20,9 @@ python etl_traces_spectrum.py type_i type_f filter_type fre_min [freq_max]
 
     freq_max: filter maximum frequency, only for bandpass and bandstop filters
 
+    fft: optional, applies the filter as a frequency mask over the trace's FFT
+    instead of a Butterworth filter
+
 Both types must be indexes in TRACE_LOCATION_MAP from load_db
 """
 
@@ -32,20 +35,30 @@ __date__ = "05/09/2021"
 import os
 import csv
 import sys
+import warnings
 
 ##Package
 from joblib import Parallel, delayed
+import numpy as np
 import obspy
 import pandas as pd
-import sqlite3
+from scipy.fft import irfft, next_fast_len, rfft, rfftfreq
+from scipy.signal import butter, sosfilt
 
 ##Local
 from extract_traces import extract_traces
-from load_db import LOCAL_SEISMIC_DB, TRACE_LOCATION_MAP
+from load_db import open_db, TRACE_LOCATION_MAP
 
-#Obspy suppported filters
+#Suppported filters
 TWO_FREQ_FILTERS = ['bandpass', 'bandstop']
 ONE_FREQ_FILTERS = ['low_pass', 'highpass']
+FILTER_BTYPES = {
+    'bandpass': 'bandpass',
+    'bandstop': 'bandstop',
+    'low_pass': 'lowpass',
+    'highpass': 'highpass'
+}
+FILTER_CORNERS = 4
 
 
 #Getting filter arguments
@@ -81,19 +94,113 @@ def get_filter_args():
     return filter_args
 
 
+#Designing Butterworth filters
+def get_filter_sos(filter_btype, filter_freqs, fs):
+    ##Documentation
+    """
+    Description
+    -----------
+    Designs the Butterworth filter sections for a sampling rate. As
+    obspy's Trace.filter did, a bandpass whose maximum frequency is at
+    or above Nyquist becomes a highpass and a bandstop becomes a lowpass,
+    a lowpass at or above Nyquist leaves the trace unfiltered. A warning
+    is issued in all these cases.
+    
+    Parameters
+    ----------
+    filter_btype: str
+        Scipy filter type, a value of FILTER_BTYPES
+    filter_freqs: int | list[int]
+        Filter frequency, or minimum and maximum frequencies
+    fs: float
+        Trace sampling rate
+    
+    Returns
+    -------
+    sos: numpy.ndarray | None
+        Filter second-order sections, None if no filter is applied
+    """
+    
+    ##Falling back when the highest frequency reaches Nyquist
+    nyquist = fs/2
+    if filter_btype in ('bandpass', 'bandstop') and filter_freqs[1] >= nyquist:
+        filter_btype = 'highpass' if filter_btype == 'bandpass' else 'lowpass'
+        filter_freqs = filter_freqs[0]
+        warnings.warn("Maximum frequency is above Nyquist ({} Hz), applying {} filter".format(nyquist, filter_btype))
+    if filter_btype == 'lowpass' and filter_freqs >= nyquist:
+        warnings.warn("Lowpass frequency is above Nyquist ({} Hz), trace is not filtered".format(nyquist))
+        return None
+    return butter(FILTER_CORNERS, filter_freqs, btype=filter_btype, fs=fs, output='sos')
+
+
+#Filtering traces in the frequency domain
+def fc_etl_filter_fft(filter_args):
+    ##Documentation
+    """
+    Description
+    -----------
+    Returns a filter function that applies an ideal frequency mask to
+    the traces' FFT. All traces have the same length, so the mask is
+    computed once per trace length and sampling rate and then reused.
+    
+    Parameters
+    ----------
+    filter_args: list
+        Filter arguments: filter_class, filter_type,
+        freq_min, freq_max (optional)
+    
+    Returns
+    -------
+    inner_etl_filter_fft: function
+        Filter function applied to an obspy stream.
+    """
+    
+    ##Creating mask function: Depends on filter_type argument
+    filter_btype = FILTER_BTYPES[filter_args[1]]
+    freq_min = filter_args[2]
+    freq_max = filter_args[3] if filter_args[0] == 1 else None
+    def get_mask(fft_len, fs):
+        freqs = rfftfreq(fft_len, 1/fs)
+        if filter_btype == 'lowpass':
+            return (freqs <= freq_min).astype(np.float32)
+        if filter_btype == 'highpass':
+            return (freqs >= freq_min).astype(np.float32)
+        band = (freqs >= freq_min) & (freqs <= freq_max)
+        if filter_btype == 'bandstop':
+            band = ~band
+        return band.astype(np.float32)
+
+    ##Masks are computed once per trace length and sampling rate
+    mask_cache = {}
+    def inner_etl_filter_fft(trace):
+        for tr in trace:
+            n = len(tr.data)
+            fs = tr.stats.sampling_rate
+            fft_len = next_fast_len(n, real=True)
+            if (fft_len, fs) not in mask_cache:
+                mask_cache[(fft_len, fs)] = get_mask(fft_len, fs)
+            tr_fft = rfft(tr.data.astype(np.float32), n=fft_len)
+            tr.data = irfft(tr_fft*mask_cache[(fft_len, fs)], n=fft_len)[:n]
+            peak = np.max(np.abs(tr.data))
+            if peak:
+                tr.data /= peak
+        return trace
+    return inner_etl_filter_fft
+
+
 #Filtering traces
-def fc_etl_filter(script_path, type_i, type_f, filter_args, total_traces):
+def fc_etl_filter(type_i, type_f, filter_args, total_traces, use_fft=False):
     ##Documentation
     """
     Description
     -----------
     Returns a filter function to process the traces by using 
-    the script's arguments.
+    the script's arguments. The filter function only receives the
+    trace index and file name and returns the index and the new
+    trace location, or None if the trace could not be processed.
     
     Parameters
     ----------
-    scripth_path: str
-        This script's path
     type_i: int
         Trace initial type
     type_f: int
@@ -103,6 +210,9 @@ def fc_etl_filter(script_path, type_i, type_f, filter_args, total_traces):
         freq_min, freq_max (optional)
     total_traces: int
         Total number of traces to process
+    use_fft: bool
+        Use the frequency mask filter from fc_etl_filter_fft
+        instead of a Butterworth filter
     
     Returns
     -------
@@ -112,33 +222,43 @@ def fc_etl_filter(script_path, type_i, type_f, filter_args, total_traces):
     
     ##Creating filter function: Depends on filter_type argument
     filter_class = filter_args[0]
-    filter_type = filter_args[1]
-    if filter_class == 0:
-        inner_etl_filter = lambda trace:\
-            trace.filter(filter_type, freq=filter_args[2]).normalize()
+    filter_btype = FILTER_BTYPES[filter_args[1]]
+    filter_freqs = filter_args[2] if filter_class == 0 else filter_args[2:4]
+
+    ##Selecting filter, Butterworth coefficients are designed once per sampling rate
+    if use_fft:
+        inner_etl_filter = fc_etl_filter_fft(filter_args)
     else:
-        inner_etl_filter = lambda trace:\
-            trace.filter(filter_type, freqmin=filter_args[2], freqmax=filter_args[3]).normalize()
+        sos_cache = {}
+        def inner_etl_filter(trace):
+            for tr in trace:
+                fs = tr.stats.sampling_rate
+                if fs not in sos_cache:
+                    sos_cache[fs] = get_filter_sos(filter_btype, filter_freqs, fs)
+                if sos_cache[fs] is not None:
+                    tr.data = sosfilt(sos_cache[fs], tr.data)
+                else:
+                    tr.data = tr.data.astype(np.float64)
+                peak = np.max(np.abs(tr.data))
+                if peak:
+                    tr.data /= peak
+            return trace
     
     ##Creating an error-proof wrapper for the filter function
-    def outter_etl_filter(trace_row):
-        i, code, station, component, start, final, file = trace_row
+    def outter_etl_filter(i_file):
+        i, file = i_file
         try:
-            os.chdir(TRACE_LOCATION_MAP[0])
-            trace = obspy.read(file)
+            trace = obspy.read(os.path.join(TRACE_LOCATION_MAP[0], file))
             trace = inner_etl_filter(trace)
-            os.chdir(TRACE_LOCATION_MAP[type_f])
-            new_trace_name = '_'.join(file.split('.')[:-1]) + '_' + str(type_f) + '.mseed'
-            trace.write(new_trace_name, format="MSEED")
+            for tr in trace:
+                tr.data = tr.data.astype(np.float32)
+            new_trace_name = file.rpartition('.')[0] + '_' + str(type_f) + '.mseed'
             new_trace_location = os.path.join(TRACE_LOCATION_MAP[type_f], new_trace_name)
-            print('{}_{}_{}: {}/{}'.format(code, station, component, i+1, total_traces))
-            return (code, station, component, start, final, type_f, new_trace_location)
+            trace.write(new_trace_location, format="MSEED", encoding="FLOAT32")
+            print('{}: {}/{}'.format(file, i+1, total_traces))
+            return (i, new_trace_location)
         except:
-            os.chdir(script_path)
-            with open('filtered_traces_' + str(type_f) + '.csv', 'a', newline='') as error_file:
-                writter = csv.writer(error_file)
-                writter.writerow([code, station, component, type_i])
-            return None
+            return (i, None)
     return outter_etl_filter
 
 
@@ -149,28 +269,43 @@ def main():
     type_i = int(sys.argv[1])
     type_f = int(sys.argv[2])
     filter_args = get_filter_args()
+    use_fft = sys.argv[-1] == 'fft'
     n_cpus = os.cpu_count()
 
     ##Database connection
-    connection = sqlite3.connect(LOCAL_SEISMIC_DB)
+    connection = open_db()
     cursor = connection.cursor()
 
     ##Trace data extraction
-    trace_df = extract_traces(cursor, 0, type_f)
+    trace_df = extract_traces(connection, 0, type_f)
     total_traces = len(trace_df)
-    trace_df = trace_df.itertuples(name=None)
+    trace_files = trace_df['file'].tolist()
 
     ##Transform & load function
-    etl_filter = fc_etl_filter(script_path, type_i, type_f, filter_args, total_traces)
+    etl_filter = fc_etl_filter(type_i, type_f, filter_args, total_traces, use_fft)
+
+    ##Transform & load function applied to trace files
+    results = Parallel(n_jobs=n_cpus, prefer="threads", batch_size=16)(delayed(etl_filter)((i, file)) for i, file in enumerate(trace_files))
+
+    ##Joining new trace locations with their trace registers
+    trace_rows = trace_df[['code', 'name', 'component', 'start', 'final']].itertuples(index=False, name=None)
+    r = []
+    errors = []
+    for (i, new_trace_location), (code, station, component, start, final) in zip(results, trace_rows):
+        if new_trace_location == None:
+            errors.append((code, station, component, type_i))
+        else:
+            r.append((code, station, component, start, final, type_f, new_trace_location))
 
-    ##Transform & load function applied to trace data
-    r = Parallel(n_jobs=n_cpus)(delayed(etl_filter)(trace_row) for trace_row in trace_df)
-    r = list(filter(lambda t_r: t_r != None, r))
+    ##Logging traces that could not be filtered
+    if len(errors) != 0:
+        with open(os.path.join(script_path, 'filtered_traces_' + str(type_f) + '.csv'), 'a', newline='') as error_file:
+            writter = csv.writer(error_file)
+            writter.writerows(errors)
 
     ##Loading new trace to database
     if len(r) != 0:
-        my_query = "INSERT INTO trace VALUES{}".format(str(tuple(r))[1:-1])
-        cursor.execute(my_query)
+        cursor.executemany("INSERT INTO trace VALUES(?,?,?,?,?,?,?)", r)
         connection.commit()
         
     ##Closing database
@@ -21,12 +21,11 @@ import random as rd
 
 ##Packages
 import pandas as pd
-import sqlite3
 import obspy
 from obspy.core.utcdatetime import UTCDateTime
 
 ##Local
-from load_db import load_trace_db, LOCAL_SEISMIC_DB, TRACE_LOCATION_MAP
+from load_db import create_trace_indexes, open_db, TRACE_LOCATION_MAP
 
 
 #Constants
@@ -38,6 +37,8 @@ WINDOW_DATETIME_FORMAT = '%Y-%m-%dT%H:%M'
 BIG_WINDOW_WIDTH = timedelta(minutes=10)
 SMALL_WINDOWS_WIDTH = timedelta(minutes=5)
 PS_OFFSET = timedelta(seconds=2)
+TRACE_BATCH_SIZE = 200
+TRACE_INSERT_QUERY = "INSERT INTO trace VALUES(?,?,?,?,?,?,?)"
 
 
 #Extracting registers
@@ -69,96 +70,65 @@ def extract_registers(cursor):
                 e.date>=c.start and e.date<=c.final \
         )
     """
-    valid_codes = cursor.execute(codes_query)
-    get_code = lambda c_t: c_t[0]
-    valid_codes = [get_code(code) for code in valid_codes]
+    valid_codes = pd.Index([code[0] for code in cursor.execute(codes_query)])
 
     ##Extracting error earthquake codes
     error_requests = pd.read_csv('raw_traces_errorRequest_codes.csv')
     error_requests.columns = ('code', 'station')
-    error_requests['code'] = [str(c) for c in error_requests['code']]
-    valid_codes = list(set(valid_codes).difference(set(error_requests['code'])))
-    valid_codes = str(tuple(valid_codes))
+    valid_codes = valid_codes.difference(pd.Index(error_requests['code'].astype(str))).tolist()
+
+    ##Storing valid codes in a temporary table, committing to release the write lock
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS valid_codes(code TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM valid_codes")
+    cursor.executemany("INSERT INTO valid_codes VALUES(?)", [(code,) for code in valid_codes])
+    cursor.connection.commit()
 
     ##Extraing registers with valid codes that do not have their raw traces
     registers_query = """
         select r.code, r.name, e.date, r.p_time, r.s_time from register as r\
+            join valid_codes v on r.code=v.code\
             join earthquake e on r.code=e.code\
-                where r.code in {} and not exists (
+                where not exists (
                     select t.code, t.name from trace as t where
                         t.type=0 and r.code=t.code and r.name=t.name
                 )
-    """.format(valid_codes)
-    valid_registers = cursor.execute(registers_query)
+    """
+    valid_registers = cursor.execute(registers_query).fetchall()
 
     ##Creating dataframe from the response
-    valid_registers = pd.DataFrame(valid_registers)
-    valid_registers.columns = ('code', 'name', 'date', 'p_time', 's_time')
+    valid_registers = pd.DataFrame.from_records(valid_registers, columns=('code', 'name', 'date', 'p_time', 's_time'))
     return valid_registers
     
 
 #Getting a column of datetime objects
-def get_datetime_column(date_column, pick_column, dt_format):
+def get_datetime_column(date_column, pick_column):
     ##Documentation
     """
     Description
     -----------
     Combines the earthquake data with its picking times to 
-    obtain picking timestamps.
+    obtain picking timestamps. The combined timestamps are
+    parsed with REGISTER_DATETIME_FORMAT in a single pandas call.
     
     Parameters
     ----------
-    date_column: list
+    date_column: pandas.core.series.Series
         Earthquake date
-    pick_column: list
+    pick_column: pandas.core.series.Series
         Register P or S pick
-    dt_format: str
-        Datetime format
     
     Returns
     -------
-    datetime_col: list
-        List of timestamps of register picks
+    datetime_col: pandas.core.series.Series
+        Column of timestamps of register picks
     """
     
     ##Combining earthquake dates and picks into timestamps
-    datetime_col = date_column + 'T' + pick_column
-    datetime_col = [datetime.strptime(datetime_i, dt_format) for datetime_i in datetime_col]
+    datetime_col = date_column.str.cat(pick_column, sep='T')
+    datetime_col = pd.to_datetime(datetime_col, format=REGISTER_DATETIME_FORMAT, cache=True)
     return datetime_col
 
 
-#Getting windows from a register instance
-def get_window_margin(pick_column, direction):
-    ##Documentation
-    """
-    Description
-    -----------
-    Sets the traces time margins using P or S pick times as reference.
-    The trace's window margins are obtained by displacing a constant amount
-    of time (determined by BIG_WINDOW_WIDTH) backwards from the P picks and
-    forwards from the S picks. Afterwards the resulting starting of finishing
-    are transformed into the API'S format (determined by WINDOW_DATETIME_FORMAT).
-    
-    Parameters
-    ----------
-    pick_column: list
-        Column with P or S pick timestamps
-    direction: int
-        Either 1 for P picks or -1 for S picks
-    
-    Returns
-    -------
-    window_margins: list
-        List of window start or final datetimes
-    """
-    
-    ##Calculating window margin
-    displacement = BIG_WINDOW_WIDTH/2
-    window_margins = [pick + direction*displacement for pick in pick_column]
-    window_margins = [datetime.strftime(w_m, WINDOW_DATETIME_FORMAT) for w_m in window_margins]
-    return window_margins
-
-
 #Downloading traces
 def extract_trace_from_api(start_time, final_time, station, network="CA", component="*", location="*", error_message="404"):
     ##Documentation
@@ -269,7 +239,8 @@ def get_shuffled_times(p_dt, s_dt):
 #Main
 def main():
     ##Connect to database
-    connection = sqlite3.connect(LOCAL_SEISMIC_DB)
+    connection = open_db()
+    create_trace_indexes(connection)
     cursor = connection.cursor()
 
     ##Extracting registers from db
@@ -280,8 +251,8 @@ def main():
     date_col = registers['date']
     p_col = registers['p_time']
     s_col = registers['s_time']
-    p_col = get_datetime_column(date_col, p_col, REGISTER_DATETIME_FORMAT)
-    s_col = get_datetime_column(date_col, s_col, REGISTER_DATETIME_FORMAT)
+    p_col = get_datetime_column(date_col, p_col)
+    s_col = get_datetime_column(date_col, s_col)
     registers['p_datetime'] = p_col
     registers['s_datetime'] = s_col
     del registers['date']
@@ -289,14 +260,16 @@ def main():
     del registers['s_time']
     del date_col
 
-    ##Transforming registers dataframe: register windows
-    registers['window_start'] = get_window_margin(p_col, -1)
-    registers['window_final'] = get_window_margin(p_col, 1)
+    ##Transforming registers dataframe: register windows around the P picks
+    half_window = BIG_WINDOW_WIDTH/2
+    registers['window_start'] = (p_col - half_window).dt.strftime(WINDOW_DATETIME_FORMAT)
+    registers['window_final'] = (p_col + half_window).dt.strftime(WINDOW_DATETIME_FORMAT)
     del p_col
     del s_col
 
     ##Extracting, shuffling and loading traces
     os.chdir(RAW_TRACE_LOCATION)
+    pending_rows = []
     for i, register in registers.iterrows():
         ###Register variables
         code = register['code']
@@ -320,23 +293,37 @@ def main():
         st_db, ft_db, st_tr, ft_tr = get_shuffled_times(p_time, s_time)
 
         ###Slicing and saving trace information
+        register_components = set()
         for tr in stream:
             tr_c = tr.slice(st_tr, ft_tr)
             component = tr_c.stats.component
             try:
+                if component in register_components:
+                    raise ValueError("Repeated component: " + component)
                 tr_c_name = "{}_{}_{}.mseed".format(code, station, component)
                 tr_c.write(tr_c_name, format="MSEED")
-                load_trace_db(cursor, code, station, component, st_db, ft_db, 0, tr_c_name)
             except:
                 print('Unique Error (code: ' + code + ', station: ' + station + ')')
                 with open(LOG_URL + '\\raw_traces_errorUNIQUE_codes.csv', 'a', newline="") as error_list:
                     writter = csv.writer(error_list)
                     writter.writerow([code, station])
                 break
-            
+            register_components.add(component)
+            tr_c_location = os.path.join(RAW_TRACE_LOCATION, tr_c_name)
+            pending_rows.append((code, station, component, st_db, ft_db, 0, tr_c_location))
+
+        ###Loading pending traces to db in batches
+        if len(pending_rows) >= TRACE_BATCH_SIZE:
+            cursor.executemany(TRACE_INSERT_QUERY, pending_rows)
+            connection.commit()
+            pending_rows.clear()
 
         ###Logging results
         print(code + '-' + station + ': ' + str(i) + '/' + total_registers)
+
+    ##Loading remaining traces
+    if len(pending_rows) != 0:
+        cursor.executemany(TRACE_INSERT_QUERY, pending_rows)
         connection.commit()
 
     ##Closing connection
@@ -16,23 +16,28 @@ __date__ = "05/09/2021"
 
 #Libraries
 ##Standard
+from math import gcd
 import os
 from sqlite3.dbapi2 import connect
 import sys
 
 ##Packages
-from joblib import Parallel, delayed
-import matplotlib.pyplot as plt
+import numpy as np
 import obspy
 import pandas as pd
-import sqlite3
+from PIL import Image
+from scipy.fft import set_workers
+from scipy.signal import resample_poly, spectrogram
 
 ##Local
 from extract_traces import extract_traces
-from load_db import LOCAL_SEISMIC_DB, TRACE_LOCATION_MAP
+from load_db import open_db, TRACE_LOCATION_MAP
 
 #Constants
 SAMPLING_RATE = 100
+NFFT = 256
+NOVERLAP = 128
+RESAMPLE_FACTORS = {}
 
 
 #Creating spectrogram from trace
@@ -42,9 +47,11 @@ def inner_etl_spectrum(trace_name, type_i, type_f):
     Description
     -----------
     Opens a trace using obspy, modifies the sampling rate to the constant SAMPLING_RATE
-    and extracts the signal data which is used to calculate as spectrogram. The axis of
-    the spectrogram is removed and the image is saved to a new direction, its file name
-    is returned.
+    with a polyphase resampler (its up and down factors are cached per original rate,
+    non-integer rates are resampled by obspy) and extracts the signal data which is used
+    to calculate as spectrogram. The spectrogram is computed in float32, converted to
+    decibels, scaled into an 8-bit grayscale image with low frequencies at the bottom
+    and saved to a new direction, its file name is returned.
     
     Parameters
     ----------
@@ -62,32 +69,43 @@ def inner_etl_spectrum(trace_name, type_i, type_f):
     """
     
     ##Extracting trace data
-    os.chdir(TRACE_LOCATION_MAP[type_i])
-    tr = obspy.read(trace_name)
-    tr.resample(SAMPLING_RATE)
-    tr_data = tr[0].data
+    tr = obspy.read(os.path.join(TRACE_LOCATION_MAP[type_i], trace_name))
+    original_rate = float(tr[0].stats.sampling_rate)
+
+    ##Resampling trace data, non-integer rates are resampled by obspy
+    if not original_rate.is_integer():
+        tr.resample(SAMPLING_RATE)
+        tr_data = tr[0].data.astype(np.float32, copy=False)
+    else:
+        original_rate = int(original_rate)
+        tr_data = tr[0].data.astype(np.float32, copy=False)
+        if original_rate != SAMPLING_RATE:
+            if original_rate not in RESAMPLE_FACTORS:
+                rate_gcd = gcd(original_rate, SAMPLING_RATE)
+                RESAMPLE_FACTORS[original_rate] = (SAMPLING_RATE//rate_gcd, original_rate//rate_gcd)
+            up, down = RESAMPLE_FACTORS[original_rate]
+            tr_data = resample_poly(tr_data, up, down)
 
     ##Calculating spectrogram
-    fig, ax = plt.subplots(1)
-    ax.specgram(
-        x = tr_data,
-        Fs=SAMPLING_RATE,
-        cmap='gray',
-        NFFT=256
+    freqs, times, spec = spectrogram(
+        tr_data,
+        fs=SAMPLING_RATE,
+        window='hann',
+        nperseg=NFFT,
+        noverlap=NOVERLAP,
+        detrend=False,
+        mode='psd'
         )
 
-    ##Removing axis from image
-    ax.axis('off')
-    plt.gca().set_axis_off()
-    plt.subplots_adjust(left=0,right=1,bottom=0,top=1,hspace=0,wspace=0)
-    plt.margins(0,0)
+    ##Scaling spectrogram into a grayscale image
+    spec = 10*np.log10(spec + 1e-12)
+    spec = (spec - spec.min()) / (np.ptp(spec) + 1e-12) * 255
+    image = Image.fromarray(spec[::-1].astype(np.uint8))
 
     ##Saving image and returning its name
-    os.chdir(TRACE_LOCATION_MAP[type_f])
     new_trace_name = '_'.join(trace_name.split('_')[:-1]) + '_' + str(type_f) + '.png'
     new_trace_location = os.path.join(TRACE_LOCATION_MAP[type_f], new_trace_name)
-    fig.savefig(new_trace_name)
-    plt.close()
+    image.save(new_trace_location, compress_level=1)
     return new_trace_location
 
 
@@ -98,7 +116,9 @@ def fo_etl_spectrum(type_i, type_f, total_traces):
     Description
     -----------
     First order function, creates a wrapper for inner_etl_spectrum using the
-    arguments passed to the scripts and the total number of trace registers found
+    arguments passed to the scripts and the total number of trace registers found.
+    The wrapper only receives the trace index and file name, the rest of the trace
+    register is kept in the main process.
     
     Parameters
     ----------
@@ -115,11 +135,11 @@ def fo_etl_spectrum(type_i, type_f, total_traces):
         Wrapper for inner_etl_spectrum
     """
     ##Creating a wrapper function
-    def outter_etl_spectrum(trace):
-        i, code, station, component, start, final, file = trace
+    def outter_etl_spectrum(i_file):
+        i, file = i_file
         new_trace_name = inner_etl_spectrum(file, type_i, type_f)
-        print('{}_{}_{}: {}/{}'.format(code, station, component, i+1, total_traces))
-        return (code, station, component, start, final, type_f, new_trace_name)
+        print('{}: {}/{}'.format(file, i+1, total_traces))
+        return (i, new_trace_name)
     return outter_etl_spectrum
 
 
@@ -131,23 +151,31 @@ def main():
     n_cpus = os.cpu_count()
 
     ##Database connection
-    connection = sqlite3.connect(LOCAL_SEISMIC_DB)
+    connection = open_db()
     cursor = connection.cursor()
 
     ##Trace data extraction
-    trace_df = extract_traces(cursor, type_i, type_f)
+    trace_df = extract_traces(connection, type_i, type_f)
     total_traces = len(trace_df)
-    trace_df = trace_df.itertuples(name=None)
+    trace_files = trace_df['file'].tolist()
 
     ##Transform & load function
     etl_spectrum = fo_etl_spectrum(type_i, type_f, total_traces)
 
-    ##Transform & load function applied to trace data
-    r = Parallel(n_jobs=n_cpus)(delayed(etl_spectrum)(trace_row) for trace_row in trace_df)
+    ##Transform & load function applied to trace files, the FFTs of each
+    ##spectrogram are spread over all cpus by scipy.fft
+    with set_workers(n_cpus):
+        results = [etl_spectrum((i, file)) for i, file in enumerate(trace_files)]
+
+    ##Joining new trace locations with their trace registers
+    trace_rows = trace_df[['code', 'name', 'component', 'start', 'final']].itertuples(index=False, name=None)
+    r = [
+        (code, station, component, start, final, type_f, new_trace_name)
+        for (i, new_trace_name), (code, station, component, start, final) in zip(results, trace_rows)
+    ]
 
     ##Loading new trace data to database
-    my_query = "INSERT INTO trace VALUES{}".format(str(tuple(r))[1:-1])
-    cursor.execute(my_query)
+    cursor.executemany("INSERT INTO trace VALUES(?,?,?,?,?,?,?)", r)
     connection.commit()
 
     ##Closing database
@@ -9,23 +9,30 @@ __author__ = "Óscar Gómez Nonnato"
 __date__ = "06/09/2021"
 
 #Libraries
+##Standard
+import os
+
 ##Packages
 import pandas as pd
 
+##Local
+from load_db import create_trace_indexes
+
 
 #Extract traces
-def extract_traces(cursor, type_i, type_f):
+def extract_traces(connection, type_i, type_f):
     ##Documentation
     """
     Description
     -----------
     Extract all trace registers of type_i that do not have
     a type_f for the same code, station name and component.
+    The trace indexes are created first if they do not exist.
     
     Parameters
     ----------
-    cursor: sqlite3.Cursor
-        sqlite3 cursor of the local database connection
+    connection: sqlite3.Connection
+        Local database connection
     type_i: int
         Trace initial type
     type_f: int
@@ -37,19 +44,17 @@ def extract_traces(cursor, type_i, type_f):
         Dataframe containing the selected traces
     """
     
+    ##Making sure trace indexes exist
+    create_trace_indexes(connection)
+
     ##Querying database
-    traces_query = f"""
-        select t1.code,t1.name,t1.component,t1.start,t1.final,t1.location from trace as t1 where t1.type={type_i} and not exists (\
-            select t2.code from trace as t2 where t2.type={type_f} and t1.code=t2.code and t1.name=t2.name and t1.component=t2.component\
+    traces_query = """
+        select t1.code,t1.name,t1.component,t1.start,t1.final,t1.location from trace as t1 where t1.type=? and not exists (\
+            select t2.code from trace as t2 where t2.type=? and t1.code=t2.code and t1.name=t2.name and t1.component=t2.component\
         )
     """
-    valid_traces = cursor.execute(traces_query)
-
-    ##Transforming response into dataframe
-    valid_traces = pd.DataFrame(valid_traces)
-    valid_traces.columns = ('code', 'name', 'component', 'start', 'final', 'location')
+    valid_traces = pd.read_sql_query(traces_query, connection, params=(type_i, type_f))
 
     ##Creating file column from locations
-    valid_traces['file'] = [ trace_location.split('\\')[-1] for trace_location in valid_traces['location']]
-    del valid_traces['location']
+    valid_traces['file'] = valid_traces.pop('location').str.rsplit(os.sep, n=1).str[-1]
     return valid_traces
\ No newline at end of file
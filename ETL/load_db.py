@@ -26,10 +26,64 @@ TRACE_LOCATION_MAP = [
     "D:\\traces\\traces_spectrogram_2hz",
     "D:\\traces\\traces_record_2hz"
 ]
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;"
+    "PRAGMA synchronous=NORMAL;"
+    "PRAGMA temp_store=MEMORY;"
+    "PRAGMA cache_size=-200000;"
+    "PRAGMA mmap_size=268435456;"
+)
+TRACE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS trace_type_key ON trace(type, code, name, component);"
+)
+
+
+#Opening the local database
+def open_db():
+    ##Documentation
+    """
+    Description
+    -----------
+    Opens a connection to the local database and applies DB_PRAGMAS.
+    The connection begins its transactions with BEGIN IMMEDIATE, so
+    every batch of inserts takes the write lock once and is synced
+    once on commit.
+    
+    Returns
+    -------
+    connection: sqlite3.Connection
+        Connection to the local database
+    """
+    
+    ##Connecting and applying pragmas
+    connection = sqlite3.connect(LOCAL_SEISMIC_DB, isolation_level='IMMEDIATE')
+    connection.executescript(DB_PRAGMAS)
+    return connection
+
+
+#Creating the trace table indexes
+def create_trace_indexes(connection):
+    ##Documentation
+    """
+    Description
+    -----------
+    Creates the TRACE_INDEXES of the local database if they do not
+    exist yet, so the trace queries of the ETL scripts search traces
+    by type instead of scanning the whole table. It must only be
+    called once the trace table exists.
+    
+    Parameters
+    ----------
+    connection: sqlite3.Connection
+        Local database connection
+    """
+    
+    ##Creating indexes
+    connection.executescript(TRACE_INDEXES)
 
 
 #Load instances into database
-def load_instances(my_instances, my_table):
+def load_instances(my_instances, my_table, connection=None):
     ##Documentation
     """
     Description
@@ -43,13 +97,18 @@ def load_instances(my_instances, my_table):
         table structure
     my_table: str
         Name of the table to load the instances
+    connection: sqlite3.Connection | None
+        Open local database connection to reuse, if None a
+        new connection is opened and closed after loading
     """
     
     ##Connect to database
-    connection = sqlite3.connect(LOCAL_SEISMIC_DB)
+    own_connection = connection == None
+    if own_connection:
+        connection = open_db()
     cursor = connection.cursor()
 
-    ##Load instances
+    ##Load instances in a single transaction
     value_placeholders = '?,'*(len(my_instances[0])-1) + '?'
     my_query = "INSERT INTO {} VALUES({});".format(my_table, value_placeholders)
     cursor.executemany(my_query, my_instances)
@@ -57,38 +116,5 @@ def load_instances(my_instances, my_table):
     ##Save changes and close
     connection.commit()
     cursor.close()
-    connection.close()
-
-
-#Load a trace in to the database
-def load_trace_db(cursor, code, station, component, start, final, t_type, doc_name):
-    ##Documentation
-    """
-    Description
-    -----------
-    Registers a trace into the local database
-    
-    Parameters
-    ----------
-    cursor: sqlite3.Cursor
-        sqlite3 cursor of the local database connection
-    code: str
-        Earthquake code
-    statio: str
-        Seismic station name
-    component:
-        Seismic station component
-    start: str
-        Trace starting timestamp
-    final: str
-        Trace finish timestamp
-    t_type: int
-        Trace type
-    doc_name: str
-        Name of the file where the trace image is located
-    """
-    
-    ##Inserting trace register into database
-    location = TRACE_LOCATION_MAP[t_type] + "\\" + doc_name
-    my_query = "INSERT INTO trace VALUES{}".format((code, station, component, start, final, str(t_type), location))
-    cursor.execute(my_query)
\ No newline at end of file
+    if own_connection:
+        connection.close()